@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import time
+
+import requests
+
+
+# Loads daily try job data from buildapi into a local SQLite database so
+# questions about trigger-bot's effectiveness can be answered without
+# re-fetching months of JSON. Days already loaded once they were over are
+# skipped, so running ingest daily only fetches what's new.
+#
+#   python warehouse.py ingest --days 90
+#   python warehouse.py pass-rate --days 90
+#   python warehouse.py retrigger-share --weeks 12
+
+base_url = 'https://secure.pub.build.mozilla.org/buildapi/self-serve'
+try_jobs = '/try?date=%(year)s-%(month)s-%(day)s&format=json'
+tbot_reason = 'Self-serve: Rebuilt by trigger-bot@mozilla.com'
+
+CONF_PATH = '../scratch/conf.json'
+DB_PATH = 'buildstats.sqlite'
+# Jobs keep finishing after the day they started is over, so a day is only
+# complete if it was loaded at least this long after midnight.
+COMPLETE_AFTER = datetime.timedelta(hours=12)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    date TEXT NOT NULL,
+    week TEXT NOT NULL,
+    buildername TEXT,
+    reason TEXT,
+    status INTEGER,
+    triggerbot INTEGER NOT NULL,
+    duration INTEGER,
+    revision TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_date ON jobs (date);
+CREATE INDEX IF NOT EXISTS jobs_builder ON jobs (triggerbot, buildername, date, status);
+CREATE INDEX IF NOT EXISTS jobs_reason ON jobs (reason, date);
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    week TEXT NOT NULL,
+    jobs INTEGER NOT NULL,
+    triggerbot_jobs INTEGER NOT NULL,
+    seconds INTEGER NOT NULL,
+    triggerbot_seconds INTEGER NOT NULL,
+    ingested REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS days_week ON days (week);
+"""
+
+
+def read_ldap_auth():
+    if os.environ.get('TB_LDAP_USERNAME') and os.environ.get('TB_LDAP_PW'):
+        return os.environ['TB_LDAP_USERNAME'], os.environ['TB_LDAP_PW']
+    with open(CONF_PATH) as f:
+        conf = json.load(f)
+        return conf['ldap_user'], conf['ldap_pw']
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def jobs_by_day(day, auth):
+    url = '%s%s' % (base_url, try_jobs % {'year': day.year,
+                                          'month': '%02d' % day.month,
+                                          'day': '%02d' % day.day})
+    info_req = requests.get(url, auth=auth)
+    return info_req.json()
+
+
+def job_reason(job):
+    if job.get('requests'):
+        return job['requests'][0].get('reason')
+    return job.get('reason')
+
+
+def iso_week(day):
+    year, week, _ = day.isocalendar()
+    return '%d-W%02d' % (year, week)
+
+
+def job_row(day, job):
+    reason = job_reason(job)
+    duration = None
+    if job.get('starttime') is not None and job.get('endtime') is not None:
+        duration = job['endtime'] - job['starttime']
+    return (day.isoformat(), iso_week(day), job.get('buildername'),
+            reason, job.get('status'), int(reason == tbot_reason), duration,
+            job.get('revision'))
+
+
+def ingest_day(db, day, jobs):
+    # Replace everything for the day in one transaction, so a partially
+    # loaded day is never visible and re-loading one is harmless.
+    with db:
+        db.execute('DELETE FROM jobs WHERE date = ?', (day.isoformat(),))
+        db.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (job_row(day, job) for job in jobs))
+        # Daily totals, so weekly questions don't need to visit every job.
+        db.execute("""
+            INSERT OR REPLACE INTO days
+            SELECT ?, ?, COUNT(*), TOTAL(triggerbot), TOTAL(duration),
+                   TOTAL(CASE WHEN triggerbot THEN duration END), ?
+            FROM jobs WHERE date = ?
+        """, (day.isoformat(), iso_week(day), time.time(), day.isoformat()))
+
+
+def ingested_days(db):
+    # date -> when it was last loaded
+    return dict(db.execute('SELECT date, ingested FROM days'))
+
+
+def is_complete(day, ingested):
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1),
+                                    datetime.time()) + COMPLETE_AFTER
+    return ingested >= time.mktime(end.timetuple())
+
+
+def ingest(db, start, end, auth, refresh=False):
+    # Load each day in [start, end] we don't already have a complete copy
+    # of, including days loaded while they were still in progress.
+    have = {} if refresh else ingested_days(db)
+    day = start
+    while day <= end:
+        ingested = have.get(day.isoformat())
+        if ingested is None or not is_complete(day, ingested):
+            jobs = jobs_by_day(day, auth)
+            ingest_day(db, day, jobs)
+            print('Loaded %d jobs for %s' % (len(jobs), day))
+        day += datetime.timedelta(days=1)
+
+
+def pass_rate_by_builder(db, days):
+    # Rows of (buildername, retriggers, passed, failed) for trigger-bot
+    # retriggers in the last "days" days, most retriggered first.
+    since = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    return db.execute("""
+        SELECT buildername, COUNT(*), SUM(status = 0), SUM(status IN (1, 2))
+        FROM jobs
+        WHERE triggerbot = 1 AND date >= ?
+        GROUP BY buildername
+        ORDER BY COUNT(*) DESC
+    """, (since,)).fetchall()
+
+
+def retrigger_share_by_week(db, weeks):
+    # Rows of (week, jobs, retriggers, seconds, retrigger seconds) for the
+    # last "weeks" weeks.
+    since = (datetime.date.today() - datetime.timedelta(weeks=weeks)).isoformat()
+    return db.execute("""
+        SELECT week, SUM(jobs), SUM(triggerbot_jobs),
+               SUM(seconds), SUM(triggerbot_seconds)
+        FROM days
+        WHERE date >= ?
+        GROUP BY week
+        ORDER BY week
+    """, (since,)).fetchall()
+
+
+def percent(part, whole):
+    return (part / float(whole)) * 100 if whole else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=DB_PATH)
+    subparsers = parser.add_subparsers(dest='command')
+
+    ingest_parser = subparsers.add_parser('ingest', help='Load daily try job data')
+    ingest_parser.add_argument('--days', type=int, default=90,
+                               help='Load the last DAYS days')
+    ingest_parser.add_argument('--start', help='First day to load, YYYY-MM-DD')
+    ingest_parser.add_argument('--end', help='Last day to load, YYYY-MM-DD')
+    ingest_parser.add_argument('--refresh', action='store_true',
+                               help='Re-load days that were already loaded')
+
+    pass_parser = subparsers.add_parser('pass-rate',
+                                        help='Trigger-bot retrigger pass rate per builder')
+    pass_parser.add_argument('--days', type=int, default=90)
+
+    share_parser = subparsers.add_parser('retrigger-share',
+                                         help='Share of try capacity spent on retriggers')
+    share_parser.add_argument('--weeks', type=int, default=12)
+
+    args = parser.parse_args()
+    db = connect(args.db)
+
+    if args.command == 'ingest':
+        end = datetime.date.today()
+        if args.end:
+            end = datetime.datetime.strptime(args.end, '%Y-%m-%d').date()
+        start = end - datetime.timedelta(days=args.days - 1)
+        if args.start:
+            start = datetime.datetime.strptime(args.start, '%Y-%m-%d').date()
+        ingest(db, start, end, read_ldap_auth(), args.refresh)
+
+    elif args.command == 'pass-rate':
+        print('%-80s %8s %8s' % ('builder', 'retriggers', 'passed'))
+        for builder, total, passed, failed in pass_rate_by_builder(db, args.days):
+            print('%-80s %8d %7.1f%%' % (builder, total, percent(passed, total)))
+
+    elif args.command == 'retrigger-share':
+        print('%-10s %8s %12s %12s' % ('week', 'jobs', 'retriggers', 'of time'))
+        for week, jobs, tbot, seconds, tbot_seconds in retrigger_share_by_week(db, args.weeks):
+            print('%-10s %8d %11.1f%% %11.1f%%' % (week, jobs, percent(tbot, jobs),
+                                                   percent(tbot_seconds, seconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# An offline load test for the complete trigger-bot process.
+#
+# Runs a local HTTP stand-in for the buildapi self-serve and Treeherder
+# endpoints the bot talks to, and an in-process stand-in for the pulse
+# BuildConsumer, then drives triggerbot_pulse.run() with generated try
+# pushes. Every message goes through extract_payload, TreeWatcher, mozci's
+# BuildApi and the TreeherderClient over real HTTP, including the Timer
+# re-attempt loop when buildapi doesn't know about a job yet.
+#
+# When the run is over we report the latency from publishing the message
+# that should cause a retrigger to the retrigger request arriving at
+# buildapi: a failure on a push that allows failure retries, or a job
+# starting on a push that asked for --rebuild.
+#
+#   python loadtest/harness.py --pushes 50 --latency-ms 200 --error-rate 0.05
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import Queue
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+
+from SocketServer import ThreadingMixIn
+
+from mozci.sources import buildapi
+from thclient import TreeherderClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from triggerbot import tree_watcher  # noqa
+from triggerbot import triggerbot_pulse  # noqa
+
+
+class JobData(object):
+    """Generates try pushes and keeps the state the fake services serve
+    back: which jobs buildapi knows about for each revision, and when each
+    message that should lead to a retrigger was published.
+    """
+    def __init__(self, builders, failure_rate, rebuild_rate, missing_rate, retry_delay):
+        self.builders = ['Ubuntu VM 12.04 x64 try debug test mochitest-%d' % (i + 1)
+                         for i in range(builders)]
+        self.failure_rate = failure_rate
+        self.rebuild_rate = rebuild_rate
+        self.missing_rate = missing_rate
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        # Pushes that asked for --rebuild, and so get requested rebuilds
+        # rather than failure retriggers.
+        self.rebuild_revs = set()
+        # rev -> list of buildapi job dicts
+        self.jobs = {}
+        # build_id or request_id -> (rev, builder)
+        self.ids = {}
+        # (rev, builder) -> time until which buildapi won't report this job,
+        # to exercise the re-attempt loop.
+        self.hidden_until = {}
+        # (rev, builder) -> time the message that should lead to a
+        # retrigger was published, for failures and requested rebuilds.
+        self.failures = {}
+        self.requests = {}
+        # (rev, builder) -> list of retrigger latencies
+        self.failure_latencies = {}
+        self.request_latencies = {}
+        self.retrigger_count = 0
+        self.messages_published = 0
+        self.next_id = 1
+
+    def push(self):
+        rev = '%012x' % random.getrandbits(48)
+        comments = 'try: -b d -p linux64 -u all -t none'
+        if random.random() < self.rebuild_rate:
+            comments += ' --rebuild %d' % random.randint(2, 5)
+            self.rebuild_revs.add(rev)
+        return rev, comments
+
+    def messages(self, rev, comments, user):
+        # Yield (key, data, failed) for every job on a push, in order.
+        for i, builder in enumerate(self.builders):
+            status = 2 if random.random() < self.failure_rate else 0
+            for state in ('started', 'finished'):
+                key = 'build.try-linux64-debug-test-mochitest-%d.%d.%s' % (
+                    i + 1, random.randint(1, 10000), state)
+                build = {
+                    'properties': [['revision', rev],
+                                   ['buildername', builder],
+                                   ['branch', 'try']],
+                    'results': status if state == 'finished' else None,
+                    'sourceStamp': {
+                        'changes': [{'comments': comments, 'who': user}],
+                    },
+                }
+                data = {'_meta': {'routing_key': key},
+                        'payload': {'build': build}}
+                yield key, data, state == 'finished' and status == 2
+
+    def job_started(self, rev, builder):
+        with self.lock:
+            job = {
+                'buildername': builder,
+                'build_id': self.next_id,
+                'request_id': self.next_id,
+                'status': None,
+            }
+            self.ids[self.next_id] = (rev, builder)
+            self.next_id += 1
+            self.jobs.setdefault(rev, []).append(job)
+            if rev in self.rebuild_revs:
+                self.requests[(rev, builder)] = time.time()
+                self._maybe_hide(rev, builder)
+
+    def job_failed(self, rev, builder):
+        # Only pushes without --rebuild get failure retriggers.
+        if rev in self.rebuild_revs:
+            return
+        with self.lock:
+            self.failures[(rev, builder)] = time.time()
+            self._maybe_hide(rev, builder)
+
+    def _maybe_hide(self, rev, builder):
+        # Buildapi is queried per revision, so we can't tell which builder
+        # a lookup is for. Instead hide the job for a whole number of retry
+        # delays from when the bot will first look for it, so that builder's
+        # own lookups miss that many times whatever else happens on the push.
+        if random.random() < self.missing_rate:
+            misses = random.randint(1, 3)
+            self.hidden_until[(rev, builder)] = (time.time() +
+                                                 (misses - 0.5) * self.retry_delay)
+
+    def jobs_for_rev(self, rev):
+        now = time.time()
+        with self.lock:
+            return [job for job in self.jobs.get(rev, [])
+                    if self.hidden_until.get((rev, job['buildername']), 0) <= now]
+
+    def retriggered(self, uuid, count):
+        now = time.time()
+        with self.lock:
+            self.retrigger_count += count
+            key = self.ids.get(uuid)
+            if key in self.requests:
+                self.request_latencies.setdefault(key, []).append(now - self.requests[key])
+            elif key in self.failures:
+                self.failure_latencies.setdefault(key, []).append(now - self.failures[key])
+
+
+class FakeServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Stand-in for the parts of buildapi self-serve and Treeherder used by
+    # trigger-bot. Paths are matched loosely so trailing slashes and query
+    # strings don't matter.
+    buildapi_rev_re = re.compile(r'^/buildapi/self-serve/([^/]+)/rev/([0-9a-f]+)')
+    buildapi_retrigger_re = re.compile(r'^/buildapi/self-serve/([^/]+)/(build|request)')
+    buildapi_branches_re = re.compile(r'^/buildapi/self-serve/branches')
+    th_resultset_re = re.compile(r'^/api/project/([^/]+)/resultset')
+    th_jobs_re = re.compile(r'^/api/project/([^/]+)/jobs')
+
+    def log_message(self, format, *args):
+        pass
+
+    def delay_or_fail(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.expovariate(1.0 / server.latency))
+        if random.random() < server.error_rate:
+            self.send_response(500)
+            self.end_headers()
+            return True
+        return False
+
+    def send_json(self, obj):
+        body = json.dumps(obj)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.delay_or_fail():
+            return
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        job_data = self.server.job_data
+
+        match = self.buildapi_rev_re.match(url.path)
+        if match:
+            return self.send_json(job_data.jobs_for_rev(match.group(2)))
+
+        if self.buildapi_branches_re.match(url.path):
+            return self.send_json({'try': {}})
+
+        match = self.th_resultset_re.match(url.path)
+        if match:
+            rev = params.get('revision', [''])[0]
+            return self.send_json({'results': [{'id': rev, 'revision': rev}]})
+
+        match = self.th_jobs_re.match(url.path)
+        if match:
+            if params.get('visibility') == ['excluded']:
+                return self.send_json({'results': []})
+            return self.send_json({'results': [{'ref_data_name': b}
+                                               for b in job_data.builders]})
+
+        self.send_response(404)
+        self.end_headers()
+
+    def do_POST(self):
+        if self.delay_or_fail():
+            return
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.getheader('Content-Length') or 0)
+        form = urlparse.parse_qs(self.rfile.read(length))
+
+        match = self.buildapi_retrigger_re.match(url.path)
+        if not match:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        field = 'build_id' if match.group(2) == 'build' else 'request_id'
+        count = int(form.get('count', ['1'])[0])
+        self.server.job_data.retriggered(int(form.get(field, ['0'])[0]), count)
+        self.send_json({'status': 'OK', 'request_id': 1})
+
+
+class FakeServiceServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, job_data, latency, error_rate):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeServiceHandler)
+        self.job_data = job_data
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+class FakeMessage(object):
+    def ack(self):
+        pass
+
+
+class FakeBuildConsumer(object):
+    """In-process stand-in for mozillapulse's BuildConsumer. Messages put
+    on `queue` are delivered to the configured callback on the thread
+    calling listen(), as they would be by the real consumer. Putting None
+    on the queue ends the run.
+    """
+    queue = Queue.Queue()
+
+    def __init__(self, applabel=None, user=None, password=None):
+        self.callback = None
+
+    def configure(self, topic=None, callback=None):
+        self.callback = callback
+
+    def listen(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                raise KeyboardInterrupt()
+            self.callback(data, FakeMessage())
+
+
+def publish(job_data, args):
+    users = ['user%d@example.com' % i for i in range(10)]
+    interval = 1.0 / args.rate if args.rate else 0
+    for _ in range(args.pushes):
+        rev, comments = job_data.push()
+        user = random.choice(users)
+        for key, data, failed in job_data.messages(rev, comments, user):
+            builder = data['payload']['build']['properties'][1][1]
+            if key.endswith('started'):
+                job_data.job_started(rev, builder)
+            if failed:
+                job_data.job_failed(rev, builder)
+            FakeBuildConsumer.queue.put(data)
+            job_data.messages_published += 1
+            if interval:
+                time.sleep(interval)
+    FakeBuildConsumer.queue.put(None)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report_latencies(name, published, latencies):
+    first = [v[0] for v in latencies.values()]
+    print('%d %s published, %d retriggered' % (len(published), name, len(first)))
+    print('\tpublish to retrigger latency (s):')
+    for p in (50, 90, 99, 100):
+        print('\t\tp%d\t%.3f' % (p, percentile(first, p)))
+
+
+def report(job_data, elapsed):
+    messages = job_data.messages_published
+    print('Processed %d messages in %.1fs (%.1f msg/s)' %
+          (messages, elapsed, messages / elapsed))
+    print('%d jobs requested from buildapi' % job_data.retrigger_count)
+    report_latencies('failures', job_data.failures, job_data.failure_latencies)
+    report_latencies('requested rebuilds', job_data.requests, job_data.request_latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pushes', type=int, default=20)
+    parser.add_argument('--builders', type=int, default=40,
+                        help='Test jobs per push')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages per second to publish, 0 for unthrottled')
+    parser.add_argument('--latency-ms', type=float, default=50,
+                        help='Mean latency of each fake service response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Proportion of service requests answered with a 500')
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--rebuild-rate', type=float, default=0.1,
+                        help='Proportion of pushes requesting --rebuild')
+    parser.add_argument('--missing-rate', type=float, default=0.1,
+                        help='Proportion of jobs buildapi initially fails to report')
+    parser.add_argument('--retry-delay', type=float, default=1)
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='Seconds to wait for delayed re-attempts to finish')
+    parser.add_argument('--trigger-workers', default='4')
+    parser.add_argument('--log-dir')
+    args = parser.parse_args()
+
+    job_data = JobData(args.builders, args.failure_rate, args.rebuild_rate,
+                       args.missing_rate, args.retry_delay)
+    server = FakeServiceServer(job_data, args.latency_ms / 1000.0, args.error_rate)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    host = '127.0.0.1:%d' % server.server_address[1]
+
+    # Point the bot at the stand-ins.
+    buildapi.HOST_ROOT = 'http://%s/buildapi/self-serve' % host
+    tree_watcher.TreeherderClient = lambda: TreeherderClient(protocol='http', host=host)
+    tree_watcher.TreeWatcher.retry_delay = args.retry_delay
+    triggerbot_pulse.consumers.BuildConsumer = FakeBuildConsumer
+    for name in ('TB_PULSE_USERNAME', 'TB_PULSE_PW', 'TB_LDAP_USERNAME', 'TB_LDAP_PW',
+                 'LDAP_USER', 'LDAP_PW'):
+        os.environ[name] = 'loadtest'
+    os.environ['TB_USERS'] = ' '.join('user%d@example.com' % i for i in range(10))
+
+    sys.argv = ['run-trigger-bot', '--trigger-workers', args.trigger_workers]
+    if args.log_dir:
+        sys.argv += ['--log-dir', args.log_dir, '--no-log-stderr']
+    else:
+        logging.disable(logging.WARNING)
+
+    # The bot runs on the main thread, as it would in production (it
+    # installs signal handlers), while pushes are published from another.
+    baseline = set(threading.enumerate())
+    start = time.time()
+    publisher = threading.Thread(target=publish, args=(job_data, args))
+    publisher.daemon = True
+    publisher.start()
+    try:
+        triggerbot_pulse.run()
+    except KeyboardInterrupt:
+        pass
+
+    # Give queued triggers and re-attempts scheduled on timers a chance
+    # to land.
+    trigger_queue = triggerbot_pulse.tw.trigger_queue
+    deadline = time.time() + args.drain_timeout
+    while time.time() < deadline:
+        if not [t for t in threading.enumerate()
+                if t not in baseline and not t.daemon and t.is_alive()]:
+            if trigger_queue is None or not trigger_queue.pending():
+                break
+        time.sleep(0.1)
+    if trigger_queue:
+        print(trigger_queue.report())
+
+    report(job_data, time.time() - start)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
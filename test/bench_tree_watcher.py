@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Lock contention benchmark for TreeWatcher. Worker threads handle failing
+# jobs on a set of revisions, with each buildapi lookup simulated by a
+# short sleep, and we compare throughput with a single lock (equivalent to
+# a global lock) against revision striping.
+#
+#   python test/bench_tree_watcher.py --threads 16 --revs 100
+
+import argparse
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from mock import Mock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from triggerbot.tree_watcher import TreeWatcher  # noqa
+
+
+def run(stripes, args):
+    TreeWatcher.lock_stripes = stripes
+    TreeWatcher.revmap_threshold = args.revs * 2
+    tw = TreeWatcher(None)
+    tw.update_hidden_builders = Mock()
+
+    def get_ids(repo_name, rev, builder):
+        time.sleep(args.lookup_ms / 1000.0)
+        return 'build', None, 0, 1000
+    tw._get_ids_for_rev = get_ids
+
+    revs = ['%012x' % i for i in range(args.revs)]
+    comments = 'try: -b o -p linux -u xpcshell -t none'
+    for rev in revs:
+        tw.handle_message('started', 'try', rev, 'b', None, comments, '')
+
+    def worker(n):
+        for i in range(args.messages):
+            rev = random.choice(revs)
+            builder = 'b%d-%d' % (n, i)
+            tw.handle_message('finished', 'try', rev, builder, 2, '', '')
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return args.threads * args.messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--revs', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=200,
+                        help='Failures handled by each thread')
+    parser.add_argument('--lookup-ms', type=float, default=2,
+                        help='Simulated buildapi lookup time')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with patch('triggerbot.tree_watcher.QUERY_SOURCE'):
+        for stripes in (1, 4, 16, 64):
+            print('%3d lock stripes: %8.1f msg/s' % (stripes, run(stripes, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import unittest
+
+from triggerbot import profiling
+from triggerbot.profiling import CallbackProfiler, StageTimer
+
+
+def worker_stage():
+    return sorted(range(100))
+
+
+class TestStageTimer(unittest.TestCase):
+
+    def test_disabled(self):
+        # Test that a disabled timer hands out the shared no-op stage and
+        # records nothing.
+        timer = StageTimer()
+        self.assertIs(profiling._null_stage, timer.stage('decode'))
+        with timer.stage('decode'):
+            pass
+        self.assertEqual({}, timer.stats)
+
+    def test_accumulate(self):
+        # Test that [count, total, max] is kept per stage.
+        timer = StageTimer()
+        timer.start()
+        timer.add('decode', 0.25)
+        timer.add('decode', 0.5)
+        timer.add('retrigger', 1.0)
+        with timer.stage('decode'):
+            pass
+
+        count, total, longest = timer.stats['decode']
+        self.assertEqual(3, count)
+        self.assertTrue(0.75 <= total < 0.8)
+        self.assertEqual(0.5, longest)
+        self.assertEqual([1, 1.0, 1.0], timer.stats['retrigger'])
+
+        timer.stop()
+        self.assertIs(profiling._null_stage, timer.stage('decode'))
+
+    def test_threads(self):
+        # Test that stages finishing on several threads are all counted.
+        timer = StageTimer()
+        timer.start()
+
+        def add():
+            for _ in range(1000):
+                timer.add('retrigger', 0.001)
+        threads = [threading.Thread(target=add) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8000, timer.stats['retrigger'][0])
+
+    def test_report(self):
+        # Test that the report lists stages, most total time first.
+        timer = StageTimer()
+        timer.start()
+        timer.add('decode', 0.1)
+        timer.add('buildapi lookup', 2.0)
+        lines = timer.report().splitlines()
+
+        self.assertTrue(lines[0].startswith('Stage timings over'))
+        self.assertTrue(lines[2].startswith('buildapi lookup'))
+        self.assertTrue(lines[3].startswith('decode'))
+        self.assertIn('2000.000', lines[2])
+
+
+class TestCallbackProfiler(unittest.TestCase):
+
+    def test_worker_threads(self):
+        # Test that work run through runcall on another thread shows up
+        # in the profile, and runs unprofiled when profiling is off.
+        profiler = CallbackProfiler()
+        self.assertEqual(list(range(100)), profiler.runcall(worker_stage))
+
+        profiler.start()
+        t = threading.Thread(target=profiler.runcall, args=(worker_stage,))
+        t.start()
+        t.join()
+        stats = profiler.stop()
+
+        functions = [func for (_, _, func) in stats.stats]
+        self.assertIn('worker_stage', functions)
+        self.assertFalse(profiler.enabled)
+
+
+class TestToggles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if profiling.stage_timer.enabled:
+            profiling.stage_timer.stop()
+        if profiling.profiler.enabled:
+            profiling.profiler.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def outputs(self, kind):
+        return sorted(f for f in os.listdir(self.tmpdir)
+                      if f.startswith('trigger-bot-%s-' % kind))
+
+    def test_toggle_stage_timer(self):
+        profiling.toggle_stage_timer(self.tmpdir)
+        self.assertTrue(profiling.stage_timer.enabled)
+        with profiling.stage('decode'):
+            pass
+        profiling.toggle_stage_timer(self.tmpdir)
+        self.assertFalse(profiling.stage_timer.enabled)
+
+        outputs = self.outputs('stages')
+        self.assertEqual(1, len(outputs))
+        with open(os.path.join(self.tmpdir, outputs[0])) as f:
+            self.assertIn('decode', f.read())
+
+    def test_extra_reports(self):
+        # Test that registered reports are written out with the stage
+        # timings.
+        reports = list(profiling._reports)
+        try:
+            profiling.add_report(lambda: 'Trigger queue latency by class:')
+            profiling.toggle_stage_timer(self.tmpdir)
+            profiling.toggle_stage_timer(self.tmpdir)
+        finally:
+            profiling._reports[:] = reports
+
+        with open(os.path.join(self.tmpdir, self.outputs('stages')[0])) as f:
+            contents = f.read()
+        self.assertIn('Stage timings over', contents)
+        self.assertIn('Trigger queue latency by class:', contents)
+
+    def test_toggle_profiler(self):
+        profiling.toggle_profiler(self.tmpdir)
+        self.assertTrue(profiling.profiler.enabled)
+        sorted(range(100))
+        profiling.toggle_profiler(self.tmpdir)
+        self.assertFalse(profiling.profiler.enabled)
+
+        outputs = self.outputs('profile')
+        self.assertEqual(2, len(outputs))
+        self.assertTrue(outputs[0].endswith('.pstats'))
+        self.assertTrue(outputs[1].endswith('.txt'))
+
+
+class TestSignalHandlers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handlers = dict((signum, signal.getsignal(signum))
+                             for signum in (signal.SIGUSR1, signal.SIGUSR2))
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        if profiling.stage_timer.enabled:
+            profiling.stage_timer.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_blocking_read_not_interrupted(self):
+        # Test that toggling a control doesn't interrupt a blocking read,
+        # like the one the pulse consumer sits in.
+        profiling.install_signal_handlers(self.tmpdir)
+        reader, writer = socket.socketpair()
+        try:
+            timer = threading.Timer(0.1, os.kill, args=(os.getpid(), signal.SIGUSR2))
+            later = threading.Timer(0.3, writer.sendall, args=('done',))
+            timer.start()
+            later.start()
+            self.assertEqual('done', reader.recv(4))
+            timer.join()
+            later.join()
+        finally:
+            reader.close()
+            writer.close()
+        self.assertTrue(profiling.stage_timer.enabled)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
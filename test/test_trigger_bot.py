@@ -2,13 +2,22 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
-from mock import Mock
+from mock import Mock, patch
 from collections import defaultdict
 
 
+from triggerbot.journal import DecisionJournal, query, read_spill, revision_history
 from triggerbot.tree_watcher import TreeWatcher
+from triggerbot.trigger_queue import FAILURE, REATTEMPT, REQUESTED, TriggerQueue
 
 
 class with_sequence(object):
@@ -156,6 +165,321 @@ class TestTriggerBot(unittest.TestCase):
     def test_no_retriggers(self):
         self.assertEqual(0, sum(self.triggers.values()))
 
+    @with_sequence(request_fail_sequence)
+    def test_journal_records_decisions(self):
+        # Test that a failure on a push that requested rebuilds is journaled
+        # as having no failure retrigger request.
+        outcomes = [r[3] for r in self.tw.journal.for_revision(1)]
+        self.assertEqual(['no-request'], outcomes)
+        self.assertEqual(outcomes, [r[3] for r in self.tw.journal.for_builder('b1')])
+
+
+class TestDecisionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.tmpdir, 'decisions.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ring_buffer(self):
+        # Test that the oldest records are evicted from the buffer and
+        # indexes and spilled to disk.
+        journal = DecisionJournal(max_records=3, spill_path=self.spill_path,
+                                  spill_batch=2)
+        for rev in ('a', 'a', 'b', 'c', 'd'):
+            journal.record(rev, 'b1', 'triggered', 1)
+
+        self.assertEqual(3, len(journal))
+        self.assertEqual([], journal.for_revision('a'))
+        self.assertEqual(1, len(journal.for_revision('b')))
+        self.assertEqual(3, len(journal.for_builder('b1')))
+        self.assertNotIn('a', journal.by_rev)
+
+        spilled = list(read_spill(self.spill_path, rev='a'))
+        self.assertEqual(2, len(spilled))
+        self.assertEqual(('a', 'b1', 'triggered', 1, 0), spilled[0][1:])
+
+    def test_flush(self):
+        # Test that evicted records short of a batch are written by flush,
+        # and can be found before then.
+        journal = DecisionJournal(max_records=1, spill_path=self.spill_path)
+        journal.record('a', 'b1', 'hidden')
+        journal.record('b', 'b1', 'hidden')
+        self.assertEqual(1, len(journal.for_revision('a')))
+        self.assertEqual([], list(read_spill(self.spill_path)))
+
+        journal.flush()
+        self.assertEqual([], journal.for_revision('a'))
+        self.assertEqual(1, len(list(read_spill(self.spill_path, rev='a'))))
+
+    def test_spill_rotation(self):
+        # Test that the spill file is rotated and read back oldest first.
+        journal = DecisionJournal(max_records=1, spill_path=self.spill_path,
+                                  spill_batch=1, spill_max_bytes=100,
+                                  spill_backups=3)
+        for i in range(20):
+            journal.record('%012d' % i, 'b1', 'triggered', 1)
+
+        self.assertTrue(os.path.exists(self.spill_path + '.3'))
+        self.assertFalse(os.path.exists(self.spill_path + '.4'))
+        revs = [entry[1] for entry in read_spill(self.spill_path)]
+        self.assertTrue(len(revs) < 19)
+        self.assertEqual(sorted(revs), revs)
+        self.assertEqual('%012d' % 18, revs[-1])
+
+    def test_query_socket(self):
+        # Test that the live buffer can be queried over the journal socket.
+        journal = DecisionJournal()
+        journal.record('abcdef123456', 'b1', 'over-tolerance', 1)
+        journal.record('abcdef123456', 'b2', 'triggered', 1)
+        path = os.path.join(self.tmpdir, 'decisions.sock')
+        server = journal.serve(path)
+        try:
+            entries = query(path, rev='abcdef123456')
+            self.assertEqual([('abcdef123456', 'b1', 'over-tolerance', 1, 0),
+                              ('abcdef123456', 'b2', 'triggered', 1, 0)],
+                             [e[1:] for e in entries])
+            self.assertEqual(1, len(query(path, builder='b2')))
+        finally:
+            server.shutdown()
+            server.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_stale_socket(self):
+        # Test that a socket left behind by a bot that's gone doesn't stop
+        # us reading the spill files.
+        journal = DecisionJournal(max_records=1, spill_path=self.spill_path)
+        journal.record('abcdef123456', 'b1', 'triggered', 1)
+        journal.record('123456abcdef', 'b1', 'triggered', 1)
+        journal.flush()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(os.path.join(self.tmpdir, 'decisions.sock'))
+        stale.close()
+
+        entries = revision_history(self.tmpdir, 'abcdef123456')
+        self.assertEqual([('abcdef123456', 'b1', 'triggered', 1, 0)],
+                         [e[1:] for e in entries])
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_revmap_threshold = TreeWatcher.revmap_threshold
+        self.orig_retry_delay = TreeWatcher.retry_delay
+        TreeWatcher.revmap_threshold = 30
+        TreeWatcher.retry_delay = 0
+        self.tw = TreeWatcher(None)
+        self.tw.update_hidden_builders = Mock()
+
+        def get_ids(repo_name, rev, builder):
+            time.sleep(0.0005)
+            # Sometimes there's nothing to retrigger yet, exercising the
+            # re-attempts on Timer threads.
+            if random.random() < 0.2:
+                return None, None, 0, 1000
+            return 'build', None, 0, 1000
+        self.tw._get_ids_for_rev = Mock(side_effect=get_ids)
+
+    def tearDown(self):
+        TreeWatcher.revmap_threshold = self.orig_revmap_threshold
+        TreeWatcher.retry_delay = self.orig_retry_delay
+
+    @patch('triggerbot.tree_watcher.QUERY_SOURCE')
+    def test_stress(self, query_source):
+        # Test that many threads failing jobs on overlapping revisions while
+        # the revmap is pruned neither lose nor duplicate triggers.
+        # (Mock's own call_count isn't thread safe.)
+        retriggers = []
+        query_source.retrigger_build.side_effect = lambda **kwargs: retriggers.append(kwargs)
+        revs = ['%012x' % i for i in range(60)]
+        builders = ['b%d' % i for i in range(8)]
+        errors = []
+        comments = 'try: -b o -p linux -u xpcshell -t none'
+        baseline = set(threading.enumerate())
+
+        def worker():
+            try:
+                for _ in range(400):
+                    rev = random.choice(revs)
+                    builder = random.choice(builders)
+                    self.tw.handle_message('started', 'try', rev, builder,
+                                           None, comments, '')
+                    self.tw.handle_message('finished', 'try', rev, builder,
+                                           2, '', '')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Wait for re-attempts. A Timer starts the next one before it
+        # finishes, so once none are left alive no more can start.
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            timers = [t for t in threading.enumerate()
+                      if t not in baseline and not t.daemon]
+            if not timers:
+                break
+            for t in timers:
+                t.join(1)
+
+        self.assertEqual([], errors)
+        records = []
+        for rev in revs:
+            records.extend(self.tw.journal.for_revision(rev))
+        triggered = [(r[1], r[2]) for r in records if r[3] == 'triggered']
+        self.assertEqual(len(triggered), len(retriggers))
+        # Each attempt that got as far as triggering or re-attempting is counted.
+        counted = [r for r in records
+                   if r[3] in ('triggered', 'retry-scheduled', 'gave-up')]
+        self.assertEqual(len(counted), self.tw.global_trigger_count)
+        # Re-attempts record which attempt they were.
+        self.assertTrue(all(r[5] >= 1 for r in records if r[3] == 'retry-scheduled'))
+        self.assertTrue(len(triggered) > 0)
+
+    @patch('triggerbot.tree_watcher.QUERY_SOURCE')
+    def test_lookup_outside_lock(self, query_source):
+        # Test that a slow buildapi lookup for one push doesn't hold up
+        # another on the same lock stripe, and that its triggers are
+        # reserved meanwhile.
+        self.tw.rev_locks = [threading.RLock()]
+        comments = 'try: -b o -p linux -u xpcshell -t none'
+        slow, fast = 'aaaaaaaaaaaa', 'bbbbbbbbbbbb'
+        in_lookup = threading.Event()
+        release = threading.Event()
+
+        def get_ids(repo_name, rev, builder):
+            if rev == slow:
+                in_lookup.set()
+                release.wait(10)
+            return 'build', None, 0, 1000
+        self.tw._get_ids_for_rev = Mock(side_effect=get_ids)
+
+        self.tw.handle_message('started', 'try', slow, 'b1', None, comments, '')
+        t = threading.Thread(target=self.tw.handle_message,
+                             args=('finished', 'try', slow, 'b1', 2, '', ''))
+        t.start()
+        try:
+            self.assertTrue(in_lookup.wait(10))
+            self.assertEqual(1, self.tw.revmap[slow]['rev_trigger_count'])
+            self.tw.handle_message('started', 'try', fast, 'b1', None, comments, '')
+            self.tw.handle_message('finished', 'try', fast, 'b1', 2, '', '')
+            self.assertEqual(1, self.tw.revmap[fast]['rev_trigger_count'])
+        finally:
+            release.set()
+            t.join()
+        self.assertEqual(1, self.tw.revmap[slow]['rev_trigger_count'])
+        self.assertEqual(2, query_source.retrigger_build.call_count)
+
+    def test_journal_counts(self):
+        # Test that count is the number of triggers even when a decision
+        # was made on buildapi's totals.
+        comments = 'try: -b o -p linux -u xpcshell -t none --rebuild 2'
+        self.tw._get_ids_for_rev = Mock(return_value=('build', None, 3, 1000))
+        self.tw.handle_message('started', 'try', 'abcdef123456', 'b1', None,
+                               comments, '')
+        self.tw.add_rev('try', '123456abcdef', comments, '')
+        self.tw._get_ids_for_rev = Mock(return_value=('build', None, 0, 10))
+        self.tw.attempt_triggers('try', '123456abcdef', 'b1', 1, seen=5)
+
+        records = (self.tw.journal.for_revision('abcdef123456') +
+                   self.tw.journal.for_revision('123456abcdef'))
+        self.assertEqual([('already-requested', 2), ('over-tolerance', 1)],
+                         [(r[3], r[4]) for r in records])
+
+
+class TestTriggerQueue(unittest.TestCase):
+
+    def drain(self, queue):
+        order = []
+        while queue.pending():
+            priority, func, args = queue.get()
+            order.append(priority)
+            func(*args)
+            queue.task_done()
+        return order
+
+    def test_weighted_order(self):
+        # Test that classes are served in proportion to their weights, and
+        # a requested rebuild doesn't wait behind every failure.
+        queue = TriggerQueue(weights={REQUESTED: 2, FAILURE: 1, REATTEMPT: 1})
+        for _ in range(6):
+            queue.put(FAILURE, lambda: None)
+        queue.put(REATTEMPT, lambda: None)
+        queue.put(REQUESTED, lambda: None)
+        queue.put(REQUESTED, lambda: None)
+
+        order = self.drain(queue)
+        self.assertEqual(REQUESTED, order[0])
+        self.assertEqual([REQUESTED, REQUESTED], [p for p in order[:4] if p == REQUESTED])
+        self.assertIn(REATTEMPT, order[:4])
+        self.assertEqual(2, queue.stats[REQUESTED][0])
+
+    def test_starvation(self):
+        # Test that something waiting longer than max_wait jumps a queue
+        # the weights would otherwise keep it at the back of.
+        queue = TriggerQueue(weights={REQUESTED: 100, FAILURE: 1, REATTEMPT: 1},
+                             max_wait=0.01)
+        queue.put(REATTEMPT, lambda: None)
+        time.sleep(0.02)
+        for _ in range(20):
+            queue.put(REQUESTED, lambda: None)
+
+        order = self.drain(queue)
+        self.assertEqual(REATTEMPT, order[TriggerQueue.starvation_interval - 1])
+        self.assertEqual(1, queue.stats[REATTEMPT][3])
+
+    def test_backlog_keeps_weights(self):
+        # Test that when everything has waited past max_wait, a requested
+        # rebuild is still served ahead of earlier failure retriggers.
+        queue = TriggerQueue(max_wait=0.01)
+        for _ in range(5):
+            queue.put(FAILURE, lambda: None)
+        queue.put(REQUESTED, lambda: None)
+        time.sleep(0.02)
+
+        order = self.drain(queue)
+        self.assertEqual(REQUESTED, order[0])
+        self.assertEqual([FAILURE] * 5, order[1:])
+
+    def test_run_times(self):
+        # Test that workers record how long each item took once dequeued.
+        queue = TriggerQueue()
+        done = threading.Event()
+        queue.put(FAILURE, time.sleep, 0.05)
+        queue.put(REQUESTED, done.set)
+        queue.start(1)
+        self.assertTrue(done.wait(10))
+        while queue.pending():
+            time.sleep(0.01)
+
+        self.assertEqual(1, queue.stats[FAILURE][4])
+        self.assertTrue(queue.stats[FAILURE][6] >= 0.05)
+        self.assertEqual(1, queue.stats[REQUESTED][4])
+        self.assertIn('max run', queue.report())
+
+    def test_queued_triggers(self):
+        # Test that TreeWatcher queues triggers by class rather than
+        # performing them as messages arrive.
+        queue = TriggerQueue()
+        tw = TreeWatcher(None, trigger_queue=queue)
+        tw.update_hidden_builders = Mock()
+        tw.attempt_triggers = Mock(return_value=1)
+
+        for key, branch, rev, builder, status, comments in failure_sequence:
+            tw.handle_message(key, branch, rev, builder, status, comments, '')
+        tw.handle_message('started', 'try', 2, 'b1', None,
+                          'try: -b o -p linux -u xpcshell -t none --rebuild 5', '')
+        self.assertEqual(0, tw.attempt_triggers.call_count)
+
+        self.assertEqual([REQUESTED, FAILURE], self.drain(queue))
+        self.assertEqual(2, tw.attempt_triggers.call_count)
+        self.assertEqual(1, tw.revmap[1]['rev_trigger_count'])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=3)
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import os
+import sys
+import time
+import unittest
+
+from mock import Mock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'buildapistats'))
+import warehouse  # noqa
+
+
+def job(builder, status, triggerbot=False, duration=100):
+    j = {'buildername': builder, 'status': status,
+         'starttime': 1000, 'endtime': 1000 + duration}
+    if triggerbot:
+        j['requests'] = [{'reason': warehouse.tbot_reason}]
+    else:
+        j['reason'] = 'scheduler'
+    return j
+
+
+class TestWarehouse(unittest.TestCase):
+
+    def setUp(self):
+        self.db = warehouse.connect(':memory:')
+        self.today = datetime.date.today()
+        self.yesterday = self.today - datetime.timedelta(days=1)
+
+    def count(self, day):
+        return self.db.execute('SELECT COUNT(*) FROM jobs WHERE date = ?',
+                               (day.isoformat(),)).fetchone()[0]
+
+    def test_ingest_day_replaces(self):
+        # Test that loading a day again replaces it rather than adding to it.
+        warehouse.ingest_day(self.db, self.today, [job('b1', 0), job('b2', 1)])
+        warehouse.ingest_day(self.db, self.yesterday, [job('b1', 0)])
+        warehouse.ingest_day(self.db, self.today, [job('b1', 0), job('b2', 0),
+                                                   job('b3', 2)])
+
+        self.assertEqual(3, self.count(self.today))
+        self.assertEqual(1, self.count(self.yesterday))
+        day_jobs = self.db.execute('SELECT jobs FROM days WHERE date = ?',
+                                   (self.today.isoformat(),)).fetchone()[0]
+        self.assertEqual(3, day_jobs)
+
+    def test_pass_rate_by_builder(self):
+        # Test that only trigger-bot jobs in range are counted, by builder.
+        warehouse.ingest_day(self.db, self.today, [
+            job('b1', 0, triggerbot=True),
+            job('b1', 0, triggerbot=True),
+            job('b1', 2, triggerbot=True),
+            job('b1', 0),
+            job('b2', 1, triggerbot=True),
+        ])
+        old = self.today - datetime.timedelta(days=100)
+        warehouse.ingest_day(self.db, old, [job('b2', 0, triggerbot=True)])
+
+        rows = warehouse.pass_rate_by_builder(self.db, 90)
+        self.assertEqual([('b1', 3, 2, 1), ('b2', 1, 0, 1)], rows)
+
+    def test_retrigger_share_by_week(self):
+        # Test that weekly shares are summed from the daily totals.
+        monday = self.today - datetime.timedelta(days=self.today.weekday() + 7)
+        tuesday = monday + datetime.timedelta(days=1)
+        warehouse.ingest_day(self.db, monday, [
+            job('b1', 0, duration=100),
+            job('b1', 0, triggerbot=True, duration=50),
+        ])
+        warehouse.ingest_day(self.db, tuesday, [
+            job('b1', 0, duration=300),
+            job('b1', 2, triggerbot=True, duration=50),
+        ])
+        # Totals come from days, not from the jobs themselves.
+        self.db.execute('DELETE FROM jobs')
+
+        rows = warehouse.retrigger_share_by_week(self.db, 4)
+        self.assertEqual([(warehouse.iso_week(monday), 4, 2, 500, 100)], rows)
+
+    def test_ingest_reloads_incomplete_days(self):
+        # Test that a day loaded while it was in progress is loaded again,
+        # but a complete one isn't.
+        complete = self.today - datetime.timedelta(days=5)
+        warehouse.ingest_day(self.db, complete, [job('b1', 0)])
+        warehouse.ingest_day(self.db, self.yesterday, [job('b1', None)])
+        # As if yesterday had been loaded before it was over.
+        self.db.execute('UPDATE days SET ingested = ? WHERE date = ?',
+                        (time.time() - 2 * 24 * 3600, self.yesterday.isoformat()))
+
+        jobs_by_day = Mock(return_value=[job('b1', 0), job('b2', 0)])
+        with patch.object(warehouse, 'jobs_by_day', jobs_by_day):
+            warehouse.ingest(self.db, complete, self.yesterday, None)
+
+        loaded = [call[0][0] for call in jobs_by_day.call_args_list]
+        self.assertNotIn(complete, loaded)
+        self.assertIn(self.yesterday, loaded)
+        self.assertEqual(2, self.count(self.yesterday))
+        self.assertEqual(1, self.count(complete))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)
@@ -0,0 +1,220 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import logging.handlers
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from collections import deque
+
+
+class DecisionJournal(object):
+    """A bounded record of every decision trigger-bot makes about a job:
+    whether it was triggered, and if not, why not.
+
+    Records are (time, rev, builder, outcome, count, attempt) tuples, where
+    count is always the number of triggers the decision was about (0 for
+    decisions made before that's known) and attempt counts re-attempts to
+    find something to retrigger. They're kept in a ring buffer and indexed
+    by revision and by builder, so looking up everything we decided about
+    a push doesn't mean scanning the logs. Once the buffer
+    is full the oldest records are evicted, and if a spill path was given
+    they're appended there as tab separated lines. The spill file is
+    rotated by size, and can be searched with read_spill (or grep).
+    The live buffer can be queried from outside the bot via serve().
+    """
+    # About 100 bytes a record, so this is on the order of 10MB.
+    default_max_records = 100000
+    # Evicted records are written out in batches of this many.
+    default_spill_batch = 1000
+    # The spill file is rotated at this size, keeping this many old ones.
+    # That's about 5 million decisions, the point is to keep far more
+    # history than the log does.
+    default_spill_max_bytes = 50 * 1000 * 1000
+    default_spill_backups = 10
+
+    def __init__(self, max_records=None, spill_path=None, spill_batch=None,
+                 spill_max_bytes=None, spill_backups=None):
+        self.max_records = max_records or DecisionJournal.default_max_records
+        self.spill_batch = spill_batch or DecisionJournal.default_spill_batch
+        self.spill_path = spill_path
+        self.spill_handler = None
+        if spill_path:
+            if spill_max_bytes is None:
+                spill_max_bytes = DecisionJournal.default_spill_max_bytes
+            if spill_backups is None:
+                spill_backups = DecisionJournal.default_spill_backups
+            self.spill_handler = logging.handlers.RotatingFileHandler(
+                spill_path, mode='a', maxBytes=spill_max_bytes,
+                backupCount=spill_backups)
+        self.records = deque()
+        self.by_rev = {}
+        self.by_builder = {}
+        self.pending_spill = []
+        self.lock = threading.Lock()
+
+    def record(self, rev, builder, outcome, count=0, attempt=0):
+        # Builder names repeat constantly, share one copy of each.
+        if builder is not None:
+            builder = intern(str(builder))
+        entry = (time.time(), rev, builder, outcome, count, attempt)
+        with self.lock:
+            if len(self.records) >= self.max_records:
+                self._evict()
+            self.records.append(entry)
+            self.by_rev.setdefault(rev, deque()).append(entry)
+            self.by_builder.setdefault(builder, deque()).append(entry)
+
+    def _evict(self):
+        # The oldest record overall is also the oldest in both of its
+        # indexes, so this is constant time.
+        entry = self.records.popleft()
+        rev, builder = entry[1:3]
+        for index, key in ((self.by_rev, rev), (self.by_builder, builder)):
+            entries = index[key]
+            entries.popleft()
+            if not entries:
+                del index[key]
+
+        if self.spill_handler:
+            self.pending_spill.append(entry)
+            if len(self.pending_spill) >= self.spill_batch:
+                self._flush()
+
+    def _flush(self):
+        msg = '\n'.join(format_record(entry) for entry in self.pending_spill)
+        self.spill_handler.emit(logging.makeLogRecord({'msg': msg}))
+        self.pending_spill = []
+
+    def flush(self):
+        with self.lock:
+            if self.spill_handler and self.pending_spill:
+                self._flush()
+
+    def for_revision(self, rev):
+        # Evicted records waiting to be spilled are on neither disk nor the
+        # indexes, so include those as well.
+        with self.lock:
+            return ([e for e in self.pending_spill if e[1] == rev] +
+                    list(self.by_rev.get(rev, ())))
+
+    def for_builder(self, builder):
+        with self.lock:
+            return ([e for e in self.pending_spill if e[2] == builder] +
+                    list(self.by_builder.get(builder, ())))
+
+    def serve(self, path):
+        # Answer queries about the live buffer on a unix socket, see query().
+        if os.path.exists(path):
+            os.unlink(path)
+        server = JournalServer(path, self)
+        t = threading.Thread(target=server.serve_forever, name='journal-server')
+        t.daemon = True
+        t.start()
+        return server
+
+    def __len__(self):
+        return len(self.records)
+
+
+class JournalRequestHandler(SocketServer.StreamRequestHandler):
+    # A request is a single "rev <rev>" or "builder <buildername>" line,
+    # answered with the matching records, one per line.
+    def handle(self):
+        kind, _, key = self.rfile.readline().strip().partition(' ')
+        journal = self.server.journal
+        if kind == 'rev':
+            entries = journal.for_revision(key)
+        elif kind == 'builder':
+            entries = journal.for_builder(key)
+        else:
+            return
+        for entry in entries:
+            self.wfile.write(format_record(entry) + '\n')
+
+
+class JournalServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, journal):
+        SocketServer.UnixStreamServer.__init__(self, path, JournalRequestHandler)
+        self.journal = journal
+
+    def close(self):
+        # Don't leave a socket nobody is listening on behind.
+        self.server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def format_record(entry):
+    return '%.3f\t%s\t%s\t%s\t%d\t%d' % entry
+
+
+def parse_record(line):
+    when, rev, builder, outcome, count, attempt = line.rstrip('\n').split('\t')
+    return float(when), rev, builder, outcome, int(count), int(attempt)
+
+
+def query(path, rev=None, builder=None):
+    # Records for a revision or builder from a running bot's journal socket.
+    if rev is not None:
+        request = 'rev %s\n' % rev
+    else:
+        request = 'builder %s\n' % builder
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall(request)
+        f = sock.makefile('r')
+        return [parse_record(line) for line in f]
+    finally:
+        sock.close()
+
+
+def read_spill(path, rev=None, builder=None):
+    # Records spilled to disk, oldest first, optionally limited to one
+    # revision or builder. However many backups the bot was keeping, they're
+    # numbered from 1 without gaps.
+    paths = [path]
+    while os.path.exists('%s.%d' % (path, len(paths))):
+        paths.append('%s.%d' % (path, len(paths)))
+    paths = paths[1:][::-1] + paths[:1]
+    for p in paths:
+        if not os.path.exists(p):
+            continue
+        with open(p) as f:
+            for line in f:
+                entry = parse_record(line)
+                if rev is not None and entry[1] != rev:
+                    continue
+                if builder is not None and entry[2] != builder:
+                    continue
+                yield entry
+
+
+def revision_history(log_dir, rev):
+    # Everything known about a revision, from the spill files and, if the
+    # bot is running, its live journal.
+    entries = list(read_spill(os.path.join(log_dir, 'decisions.tsv'), rev=rev))
+    socket_path = os.path.join(log_dir, 'decisions.sock')
+    if os.path.exists(socket_path):
+        try:
+            entries.extend(query(socket_path, rev=rev))
+        except socket.error:
+            # Left behind by a bot that didn't exit cleanly.
+            pass
+    return entries
+
+
+if __name__ == '__main__':
+    # python -m triggerbot.journal <log dir> <rev>
+    log_dir, rev = sys.argv[1:3]
+    for entry in revision_history(log_dir, rev):
+        print(format_record(entry))
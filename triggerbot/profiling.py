@@ -0,0 +1,214 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Profiling controls that can be toggled on a running trigger-bot with
+# signals, so we can see where time goes when the bot falls behind
+# without redeploying:
+#
+#   kill -USR1 <pid>  start/stop cProfile over the pulse callback thread
+#                     and trigger workers
+#   kill -USR2 <pid>  start/stop per-stage wall-clock timing, along with
+#                     anything registered with add_report
+#
+# Results are written to the log directory when a control is stopped.
+
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import time
+
+from threading import Lock
+
+
+class _NullStage(object):
+    # Shared do-nothing context manager handed out while stage timing is
+    # off, so a disabled timer costs an attribute check and a method call.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """Accumulate wall-clock time spent in named stages of message handling
+    (decode, revmap update, hidden builder refresh, buildapi lookup,
+    retrigger). Does nothing unless enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        self.stats = {}
+        # Stages finish on the pulse thread, trigger workers and timers.
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            self.stats = {}
+        self.started = time.time()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def add(self, name, elapsed):
+        # [count, total, max]
+        with self.lock:
+            entry = self.stats.get(name)
+            if entry is None:
+                entry = self.stats[name] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+
+    def report(self):
+        lines = ['Stage timings over %.1fs' % (time.time() - self.started)]
+        lines.append('%-20s %8s %12s %12s %12s' %
+                     ('stage', 'count', 'total (s)', 'mean (ms)', 'max (ms)'))
+        with self.lock:
+            stats = [(name, list(entry)) for name, entry in self.stats.items()]
+        for name, (count, total, longest) in sorted(stats, key=lambda (k, v): -v[1]):
+            lines.append('%-20s %8d %12.3f %12.3f %12.3f' %
+                         (name, count, total, total * 1000 / count, longest * 1000))
+        return '\n'.join(lines)
+
+
+class CallbackProfiler(object):
+    """Deterministic profiler over the thread that toggles it, and over
+    work passed to runcall. Signal handlers run on the main thread, which
+    is the thread running consumer.listen() and therefore every pulse
+    callback; trigger workers run each item through runcall so buildapi
+    lookups and retriggers are profiled too. Timer threads aren't profiled,
+    with a trigger queue all they do is queue a re-attempt.
+    """
+    def __init__(self):
+        self.profile = None
+        # Finished profiles from other threads, merged as they complete.
+        self.thread_stats = None
+        self.lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.profile is not None
+
+    def start(self):
+        with self.lock:
+            self.thread_stats = None
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def runcall(self, func, *args):
+        main_profile = self.profile
+        if main_profile is None:
+            return func(*args)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            profile.create_stats()
+            with self.lock:
+                # Drop it if profiling stopped (or restarted) meanwhile.
+                if self.profile is main_profile:
+                    if self.thread_stats is None:
+                        self.thread_stats = pstats.Stats(profile)
+                    else:
+                        self.thread_stats.add(profile)
+
+    def stop(self):
+        # Returns the combined pstats.Stats for every profiled thread.
+        with self.lock:
+            profile, self.profile = self.profile, None
+            thread_stats, self.thread_stats = self.thread_stats, None
+        profile.disable()
+        stats = pstats.Stats(profile)
+        if thread_stats is not None:
+            stats.add(thread_stats)
+        return stats
+
+
+stage_timer = StageTimer()
+profiler = CallbackProfiler()
+# Functions returning other reports to write out with the stage timings.
+_reports = []
+
+
+def stage(name):
+    return stage_timer.stage(name)
+
+
+def add_report(func):
+    _reports.append(func)
+
+
+def _output_path(log_dir, kind):
+    return os.path.join(log_dir or '.', 'trigger-bot-%s-%s' %
+                        (kind, time.strftime('%Y%m%d-%H%M%S')))
+
+
+def toggle_profiler(log_dir):
+    log = logging.getLogger('trigger-bot')
+    if not profiler.enabled:
+        log.info('Starting callback profiler')
+        profiler.start()
+        return
+
+    stats = profiler.stop()
+    path = _output_path(log_dir, 'profile')
+    stats.dump_stats(path + '.pstats')
+    with open(path + '.txt', 'w') as f:
+        stats.stream = f
+        stats.sort_stats('cumulative').print_stats(50)
+    log.info('Stopped callback profiler, wrote %s.pstats' % path)
+
+
+def toggle_stage_timer(log_dir):
+    log = logging.getLogger('trigger-bot')
+    if not stage_timer.enabled:
+        log.info('Starting stage timer')
+        stage_timer.start()
+        return
+
+    stage_timer.stop()
+    report = '\n\n'.join([stage_timer.report()] + [func() for func in _reports])
+    path = _output_path(log_dir, 'stages') + '.txt'
+    with open(path, 'w') as f:
+        f.write(report + '\n')
+    log.info(report)
+    log.info('Stopped stage timer, wrote %s' % path)
+
+
+def install_signal_handlers(log_dir):
+    signal.signal(signal.SIGUSR1, lambda signum, frame: toggle_profiler(log_dir))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: toggle_stage_timer(log_dir))
+    # Python installs handlers without SA_RESTART, so a toggle would
+    # otherwise interrupt the consumer's blocking read with EINTR.
+    signal.siginterrupt(signal.SIGUSR1, False)
+    signal.siginterrupt(signal.SIGUSR2, False)
@@ -8,16 +8,36 @@ import logging
 import re
 import time
 
-from threading import Timer
-from collections import defaultdict
+from threading import Lock, RLock, Timer
 
 from mozci.query_jobs import BuildApi
 from thclient import TreeherderClient
 
+from .journal import DecisionJournal
+from .profiling import stage
+from .trigger_queue import FAILURE, REATTEMPT, REQUESTED
+
 
 QUERY_SOURCE = BuildApi()
 
 
+class AtomicCounter(object):
+    # A counter that can be shared between the consumer thread, timers
+    # and trigger workers.
+    def __init__(self, value=0):
+        self._value = value
+        self._lock = Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self._value += n
+            return self._value
+
+    @property
+    def value(self):
+        return self._value
+
+
 class TreeWatcher(object):
     """Class to keep track of test jobs starting and finishing, known
     revisions and builders, and re-trigger jobs in either when a job
@@ -28,6 +48,15 @@ class TreeWatcher(object):
     once. Old revisions are purged after a certain interval, so care must
     be taken that enough revisions are stored at a time to prevent issuing
     redundant triggers.
+    Decisions about a revision are made while holding that revision's lock,
+    one of a fixed set of locks striped by revision, so Timer re-attempts
+    and messages for the same push are serialized while different pushes
+    proceed in parallel. The lock is only held to read and update the
+    revmap, never across a buildapi call, so a slow lookup for one push
+    doesn't hold up others on the same stripe.
+    Given a TriggerQueue, the buildapi lookups and retriggers themselves are
+    queued by class (requested, failure, re-attempt) and handled by its
+    workers, otherwise they happen as messages arrive.
     """
     # Allow at least this many failures for a revision.
     # If we re-trigger for each orange and per-push orange
@@ -43,20 +72,59 @@ class TreeWatcher(object):
     revmap_threshold = 2000
     # If someone asks for more than 20 rebuilds on a push, only give them 20.
     requested_limit = 20
-
-    def __init__(self, ldap_auth, is_triggerbot_user=lambda _: True):
-        self.revmap = defaultdict(dict)
+    # Seconds to wait before looking again for a build to retrigger when
+    # buildapi doesn't know about it yet.
+    retry_delay = 90
+    # Refresh the set of hidden builders every this many messages.
+    refresh_builder_interval = 300
+    # Number of locks revisions are striped across.
+    lock_stripes = 64
+
+    def __init__(self, ldap_auth, is_triggerbot_user=lambda _: True, journal=None,
+                 trigger_queue=None):
+        self.revmap = {}
         self.revmap_threshold = TreeWatcher.revmap_threshold
         self.auth = ldap_auth
         self.lower_trigger_limit = TreeWatcher.default_retry * TreeWatcher.per_push_failures
         self.log = logging.getLogger('trigger-bot')
         self.is_triggerbot_user = is_triggerbot_user
-        self.global_trigger_count = 0
+        self.trigger_count = AtomicCounter()
         self.treeherder_client = TreeherderClient()
-        self.hidden_builders = set()
-        self.refresh_builder_counter = 0
+        self.hidden_builders = frozenset()
+        self.message_count = AtomicCounter()
+        self.rev_locks = [RLock() for _ in range(TreeWatcher.lock_stripes)]
+        self.prune_lock = Lock()
+        self.hidden_builders_lock = Lock()
+        # Every trigger decision, so we can answer why something was or
+        # wasn't retriggered.
+        if journal is None:
+            journal = DecisionJournal()
+        self.journal = journal
+        self.trigger_queue = trigger_queue
+
+    @property
+    def global_trigger_count(self):
+        return self.trigger_count.value
+
+    def rev_lock(self, rev):
+        return self.rev_locks[hash(rev) % len(self.rev_locks)]
+
+    def schedule(self, priority, func, *args):
+        if self.trigger_queue is None:
+            return func(*args)
+        self.trigger_queue.put(priority, func, *args)
 
     def _prune_revmap(self):
+        # Only one thread needs to prune at a time, anyone else arriving here
+        # can carry on.
+        if not self.prune_lock.acquire(False):
+            return
+        try:
+            self._prune_revmap_locked()
+        finally:
+            self.prune_lock.release()
+
+    def _prune_revmap_locked(self):
         # After a certain point we'll need to prune our revmap so it doesn't grow
         # infinitely.
         # We only need to keep an entry around from when we last see it
@@ -76,7 +144,15 @@ class TreeWatcher(object):
                 self.log.info('Finished pruning, oldest rev is now: %s' % rev)
                 return
 
-            del self.revmap[rev]
+            # A revision someone is busy with isn't one we want to prune,
+            # skip it rather than wait.
+            lock = self.rev_lock(rev)
+            if not lock.acquire(False):
+                continue
+            try:
+                self.revmap.pop(rev, None)
+            finally:
+                lock.release()
             prune_count -= 1
 
     def known_rev(self, repo_name, rev):
@@ -106,8 +182,11 @@ class TreeWatcher(object):
     def update_hidden_builders(self, repo_name, rev):
         hidden_builders = set(self.get_hidden_jobs(repo_name, rev))
         visible_builders = set(self.get_visible_jobs(repo_name, rev))
-        self.hidden_builders -= visible_builders
-        self.hidden_builders |= hidden_builders
+        # Replace rather than mutate the set, it's read from other threads
+        # without the lock.
+        with self.hidden_builders_lock:
+            self.hidden_builders = ((self.hidden_builders - visible_builders) |
+                                    hidden_builders)
         self.log.info('Updating hidden builders')
         self.log.info('There are %d hidden builders on try' %
                       len(self.hidden_builders))
@@ -119,6 +198,7 @@ class TreeWatcher(object):
             if 'fail_retrigger' not in self.revmap[rev]:
                 self.log.info('Found no request to retrigger %s on failure' %
                               rev)
+                self.journal.record(rev, builder, 'no-request')
                 return
 
             seen_builders = self.revmap[rev]['seen_builders']
@@ -126,22 +206,40 @@ class TreeWatcher(object):
             if builder in seen_builders:
                 self.log.info('We\'ve already seen "%s" at %s and don\'t'
                               ' need to trigger it' % (builder, rev))
+                self.journal.record(rev, builder, 'already-seen')
                 return
 
             if builder in self.hidden_builders:
                 self.log.info('Would have triggered "%s" at %s due to failures,'
                               ' but that builder is hidden.' % (builder, rev))
+                self.journal.record(rev, builder, 'hidden')
                 return
 
             seen_builders.add(builder)
 
             count = self.revmap[rev]['fail_retrigger']
+            return FAILURE, self._failure_attempt, repo_name, rev, builder, count
+
+    def _failure_attempt(self, repo_name, rev, builder, count):
+        with self.rev_lock(rev):
+            if rev not in self.revmap:
+                self.journal.record(rev, builder, 'pruned', count)
+                return
+            # Read this when we get to it rather than when it was queued,
+            # earlier failures on the push may have been triggered since.
             seen = self.revmap[rev]['rev_trigger_count']
+            # Reserve our triggers before letting go of the lock, so failures
+            # on the same push handled meanwhile count them.
+            self.revmap[rev]['rev_trigger_count'] += count
+
+        triggered = self.attempt_triggers(repo_name, rev, builder, count, seen) or 0
 
-            triggered = self.attempt_triggers(repo_name, rev, builder, count, seen)
-            if triggered:
-                self.revmap[rev]['rev_trigger_count'] += triggered
-                self.log.info('Triggered %d of "%s" at %s' % (triggered, builder, rev))
+        with self.rev_lock(rev):
+            # Give back whatever we didn't use.
+            if triggered < count and rev in self.revmap:
+                self.revmap[rev]['rev_trigger_count'] -= count - triggered
+        if triggered:
+            self.log.info('Triggered %d of "%s" at %s' % (triggered, builder, rev))
 
     def requested_trigger(self, repo_name, rev, builder):
         if rev in self.revmap and 'requested_trigger' in self.revmap[rev]:
@@ -152,6 +250,7 @@ class TreeWatcher(object):
             if builder in seen_builders:
                 self.log.info('We already triggered "%s" at %s don\'t need'
                               ' to do it again' % (builder, rev))
+                self.journal.record(rev, builder, 'already-seen')
                 return
 
             seen_builders.add(builder)
@@ -161,33 +260,38 @@ class TreeWatcher(object):
 
             self.log.info('May trigger %d requested jobs for "%s" at %s' %
                           (count, builder, rev))
-            self.attempt_triggers(repo_name, rev, builder, count)
+            return REQUESTED, self.attempt_triggers, repo_name, rev, builder, count
 
     def add_rev(self, repo_name, rev, comments, user):
 
         req_count, req_talos_count, should_retry = self.triggers_from_msg(comments)
+        # Fill in the entry before adding it to the revmap, other threads
+        # may look at it as soon as it's there.
+        data = {}
 
         # Only trigger based on a request or a failure, not both.
         if req_count or req_talos_count:
             self.log.info('Added %d triggers for %s' % (req_count, rev))
-            self.revmap[rev]['requested_trigger'] = (req_count, req_talos_count)
+            data['requested_trigger'] = (req_count, req_talos_count)
 
         if should_retry and not req_count:
             # self.log.info('Adding default failure retries for %s' % rev)
-            self.revmap[rev]['fail_retrigger'] = TreeWatcher.default_retry
+            data['fail_retrigger'] = TreeWatcher.default_retry
 
-        self.revmap[rev]['rev_trigger_count'] = 0
+        data['rev_trigger_count'] = 0
 
         # When we need to purge old revisions, we need to purge the
         # oldest first.
-        self.revmap[rev]['time_seen'] = time.time()
+        data['time_seen'] = time.time()
 
         # Prevent an infinite retrigger loop - if we take a trigger action,
         # ensure we only take it once for a builder on a particular revision.
-        self.revmap[rev]['seen_builders'] = set()
+        data['seen_builders'] = set()
 
         # Filter triggering activity based on users.
-        self.revmap[rev]['user'] = user
+        data['user'] = user
+
+        self.revmap[rev] = data
 
         if len(self.revmap.keys()) > self.revmap_threshold:
             self._prune_revmap()
@@ -225,35 +329,58 @@ class TreeWatcher(object):
         return rebuilds, rebuild_talos, args.retry
 
     def handle_message(self, key, repo_name, rev, builder, status, comments, user):
-        if not self.known_rev(repo_name, rev) and comments:
-            # First time we've seen this revision? Add it to known
-            # revs and mark required triggers,
-            self.add_rev(repo_name, rev, comments, user)
-
-        if key.endswith('started'):
-            # If the job is starting and a user requested unconditional
-            # retriggers, process them right away.
-            self.requested_trigger(repo_name, rev, builder)
-
-        if status in (1, 2):
-            # A failing job is a candidate to retrigger.
-            self.failure_trigger(repo_name, rev, builder)
-
-        if self.refresh_builder_counter == 0:
-            self.update_hidden_builders(repo_name, rev)
-            self.refresh_builder_counter = 300
-        else:
-            self.refresh_builder_counter -= 1
+        # Decide what to trigger under the revision's lock, but schedule it
+        # (which without a trigger queue means doing it) after letting go.
+        work = []
+        with self.rev_lock(rev):
+            if not self.known_rev(repo_name, rev) and comments:
+                # First time we've seen this revision? Add it to known
+                # revs and mark required triggers,
+                with stage('revmap update'):
+                    self.add_rev(repo_name, rev, comments, user)
+
+            if key.endswith('started'):
+                # If the job is starting and a user requested unconditional
+                # retriggers, process them right away.
+                work.append(self.requested_trigger(repo_name, rev, builder))
+
+            if status in (1, 2):
+                # A failing job is a candidate to retrigger.
+                work.append(self.failure_trigger(repo_name, rev, builder))
+
+        for item in work:
+            if item:
+                self.schedule(*item)
+
+        if (self.message_count.add() - 1) % self.refresh_builder_interval == 0:
+            with stage('hidden builders'):
+                self.update_hidden_builders(repo_name, rev)
 
     def attempt_triggers(self, repo_name, rev, builder, count, seen=0, attempt=0):
+        # Re-attempts arrive here after a delay, so check the revision wasn't
+        # pruned while we were waiting. Only what we need from the revmap is
+        # read under the lock, buildapi calls happen outside it.
+        with self.rev_lock(rev):
+            if rev not in self.revmap:
+                self.log.warning('Not triggering "%s" at %s, we no longer know about '
+                                 'that revision' % (builder, rev))
+                self.journal.record(rev, builder, 'pruned', count, attempt)
+                return
+            user = self.revmap[rev]['user']
+        return self._attempt_triggers(repo_name, rev, builder, count, seen, attempt, user)
+
+    def _attempt_triggers(self, repo_name, rev, builder, count, seen, attempt, user):
         if not re.match('[a-z0-9]{12}', rev):
             self.log.error('%s doesn\'t look like a valid revision, can\'t trigger it' %
                            rev)
+            self.journal.record(rev, builder, 'invalid-rev', count)
             return
 
-        build_data = self._get_ids_for_rev(repo_name, rev, builder)
+        with stage('buildapi lookup'):
+            build_data = self._get_ids_for_rev(repo_name, rev, builder)
 
         if build_data is None:
+            self.journal.record(rev, builder, 'lookup-failed', count)
             return
 
         found_buildid, found_requestid, builder_total, rev_total = build_data
@@ -262,6 +389,7 @@ class TreeWatcher(object):
             self.log.warning('Would have triggered %d of "%s" at %s, but we\'ve already'
                              ' found more requests than that for this builder/rev.' %
                              (count, builder, rev))
+            self.journal.record(rev, builder, 'already-requested', count)
             return
 
         self.log.info("Found %s jobs total for %s" % (rev_total, rev))
@@ -269,33 +397,39 @@ class TreeWatcher(object):
                 seen > self.lower_trigger_limit):
             self.log.warning('Would have triggered "%s" at %s but there are already '
                              'too many failures.' % (builder, rev))
+            self.journal.record(rev, builder, 'over-tolerance', count)
             return
 
-        self.global_trigger_count += count
+        total = self.trigger_count.add(count)
         self.log.warning('Up to %d total triggers have been performed by this service.' %
-                         self.global_trigger_count)
+                         total)
 
-        if not self.is_triggerbot_user(self.revmap[rev]['user']):
+        if not self.is_triggerbot_user(user):
             self.log.warning('Would have triggered "%s" at %s %d times.' %
                              (builder, rev, count))
-            self.log.warning('But %s is not a triggerbot user.' % self.revmap[rev]['user'])
+            self.log.warning('But %s is not a triggerbot user.' % user)
+            self.journal.record(rev, builder, 'not-a-user', count)
             # Pretend we did these triggers, just for accounting purposes.
             return count
 
         self.log.info('attempt_triggers, attempt %d' % attempt)
 
         if found_buildid:
-            QUERY_SOURCE.retrigger_build(uuid=found_buildid,
-                                         auth=self.auth,
-                                         repo_name=repo_name,
-                                         count=count,
-                                         dry_run=False)
+            with stage('retrigger'):
+                QUERY_SOURCE.retrigger_build(uuid=found_buildid,
+                                             auth=self.auth,
+                                             repo_name=repo_name,
+                                             count=count,
+                                             dry_run=False)
+            self.journal.record(rev, builder, 'triggered', count)
         elif found_requestid:
-            QUERY_SOURCE.retrigger(uuid=found_requestid,
-                                   auth=self.auth,
-                                   repo_name=repo_name,
-                                   count=count,
-                                   dry_run=False)
+            with stage('retrigger'):
+                QUERY_SOURCE.retrigger(uuid=found_requestid,
+                                       auth=self.auth,
+                                       repo_name=repo_name,
+                                       count=count,
+                                       dry_run=False)
+            self.journal.record(rev, builder, 'triggered', count)
         else:
             # For a short time after a job starts it seems there might not be
             # any info associated with this job/builder in.
@@ -306,11 +440,14 @@ class TreeWatcher(object):
             if attempt > 4:
                 self.log.warning('Already tried to find something to rebuild '
                                  'for "%s" at %s, giving up' % (builder, rev))
+                self.journal.record(rev, builder, 'gave-up', count, attempt)
                 return
 
             self.log.warning('Will re-attempt')
-            tm = Timer(90, self.attempt_triggers,
-                       args=[repo_name, rev, builder, count, seen, attempt + 1])
+            self.journal.record(rev, builder, 'retry-scheduled', count, attempt + 1)
+            tm = Timer(self.retry_delay, self.schedule,
+                       args=[REATTEMPT, self.attempt_triggers,
+                             repo_name, rev, builder, count, seen, attempt + 1])
             tm.start()
             # Assume some subsequent attempt will be succesful for accounting
             # purposes.
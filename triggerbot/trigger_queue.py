@@ -0,0 +1,159 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import time
+
+from collections import deque
+from threading import Condition, Thread
+
+from .profiling import profiler
+
+# Classes of trigger work, in order of preference when all else is equal.
+REQUESTED = 'requested'
+FAILURE = 'failure'
+REATTEMPT = 'reattempt'
+PRIORITIES = (REQUESTED, FAILURE, REATTEMPT)
+
+
+class TriggerQueue(object):
+    """Queue of pending trigger work, drained by worker threads so the
+    pulse consumer doesn't wait on buildapi.
+
+    Work is queued in one of three classes: rebuilds users asked for,
+    retriggers of failures, and delayed re-attempts. Classes are served in
+    proportion to their weights (smooth weighted round robin), so during an
+    orange storm a requested rebuild only waits behind a few failure
+    retriggers rather than all of them. To keep any class from starving,
+    something that has waited longer than max_wait may jump the queue, but
+    at most once every starvation_interval items. In a sustained backlog
+    everything has waited that long, and the weights still decide the
+    rest.
+    """
+    default_weights = {
+        REQUESTED: 6,
+        FAILURE: 3,
+        REATTEMPT: 1,
+    }
+    # Seconds an item may wait before it jumps the queue.
+    max_wait = 120
+    # Let a starving item jump the queue at most once in this many items.
+    starvation_interval = 4
+    # Log per-class latencies every this many items. They're also written
+    # out with the stage timings, see profiling.add_report.
+    report_interval = 500
+
+    def __init__(self, weights=None, max_wait=None):
+        self.weights = weights or dict(TriggerQueue.default_weights)
+        self.max_wait = max_wait if max_wait is not None else TriggerQueue.max_wait
+        self.queues = dict((p, deque()) for p in PRIORITIES)
+        self.credit = dict((p, 0) for p in PRIORITIES)
+        # priority -> [served, total wait, max wait, times starved,
+        #              completed, total run time, max run time]
+        self.stats = dict((p, [0, 0.0, 0.0, 0, 0, 0.0, 0.0]) for p in PRIORITIES)
+        self.in_flight = 0
+        self.served = 0
+        self.since_promotion = 0
+        self.cond = Condition()
+        self.log = logging.getLogger('trigger-bot')
+
+    def put(self, priority, func, *args):
+        with self.cond:
+            self.queues[priority].append((time.time(), func, args))
+            self.cond.notify()
+
+    def _next_priority(self, now):
+        # Returns the class to serve next, and whether it's because
+        # something in it was starving.
+        self.since_promotion += 1
+        if self.since_promotion >= self.starvation_interval:
+            starving = [(q[0][0], p) for p, q in self.queues.items()
+                        if q and now - q[0][0] > self.max_wait]
+            if starving:
+                self.since_promotion = 0
+                return min(starving)[1], True
+
+        best = None
+        total = 0
+        for p in PRIORITIES:
+            if not self.queues[p]:
+                continue
+            self.credit[p] += self.weights[p]
+            total += self.weights[p]
+            if best is None or self.credit[p] > self.credit[best]:
+                best = p
+        self.credit[best] -= total
+        return best, False
+
+    def get(self):
+        # Block until there's work, and return (priority, func, args).
+        with self.cond:
+            while not any(self.queues.values()):
+                self.cond.wait()
+
+            now = time.time()
+            priority, starved = self._next_priority(now)
+            enqueued, func, args = self.queues[priority].popleft()
+            self.in_flight += 1
+
+            wait = now - enqueued
+            stats = self.stats[priority]
+            stats[0] += 1
+            stats[1] += wait
+            if wait > stats[2]:
+                stats[2] = wait
+            if starved:
+                stats[3] += 1
+
+            self.served += 1
+            if self.served % self.report_interval == 0:
+                self.log.info(self.report())
+            return priority, func, args
+
+    def task_done(self, priority=None, elapsed=None):
+        # Given the item's class, elapsed is the time from dequeue to
+        # completion.
+        with self.cond:
+            self.in_flight -= 1
+            if priority is not None:
+                stats = self.stats[priority]
+                stats[4] += 1
+                stats[5] += elapsed
+                if elapsed > stats[6]:
+                    stats[6] = elapsed
+
+    def pending(self):
+        # Items queued or being worked on.
+        with self.cond:
+            return sum(len(q) for q in self.queues.values()) + self.in_flight
+
+    def run(self):
+        while True:
+            priority, func, args = self.get()
+            started = time.time()
+            try:
+                profiler.runcall(func, *args)
+            except Exception:
+                self.log.exception('Unexpected exception handling %s trigger' % priority)
+            finally:
+                self.task_done(priority, time.time() - started)
+
+    def start(self, workers):
+        for i in range(workers):
+            t = Thread(target=self.run, name='trigger-worker-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def report(self):
+        lines = ['Trigger queue latency by class:']
+        with self.cond:
+            for p in PRIORITIES:
+                served, total, longest, starved, done, run, longest_run = self.stats[p]
+                mean = total / served if served else 0
+                mean_run = run / done if done else 0
+                lines.append('\t%-10s queued %5d served %7d mean wait %7.2fs '
+                             'max wait %7.2fs starved %d mean run %7.2fs max run %7.2fs' %
+                             (p, len(self.queues[p]), served, mean, longest, starved,
+                              mean_run, longest_run))
+        return '\n'.join(lines)
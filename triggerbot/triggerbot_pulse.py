@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import atexit
 import json
 import logging
 import os
@@ -11,7 +12,10 @@ import sys
 
 from mozillapulse import consumers
 
+from .journal import DecisionJournal
+from .profiling import add_report, install_signal_handlers, stage
 from .tree_watcher import TreeWatcher
+from .trigger_queue import TriggerQueue
 
 logger = None
 CONF_PATH = '../scratch/conf.json'
@@ -67,8 +71,9 @@ def handle_message(data, message):
 
     message.ack()
     key = data['_meta']['routing_key']
-    (branch, rev, builder, status,
-     is_test, comments, user) = extract_payload(data['payload'], key)
+    with stage('decode'):
+        (branch, rev, builder, status,
+         is_test, comments, user) = extract_payload(data['payload'], key)
 
     if not all([branch == 'try',
                 is_test]):
@@ -139,6 +144,15 @@ def run():
     parser.add_argument('--log-dir')
     parser.add_argument('--no-log-stderr', dest='log_stderr',
                         action='store_false', default=True)
+    parser.add_argument('--trigger-workers', dest='trigger_workers', type=int, default=4,
+                        help='Threads looking up and retriggering jobs, 0 to do '
+                             'this on the pulse thread as messages arrive')
+    parser.add_argument('--journal-file-mb', dest='journal_file_mb', type=int,
+                        default=DecisionJournal.default_spill_max_bytes / 1000000,
+                        help='Rotate the on-disk decision journal at this size')
+    parser.add_argument('--journal-files', dest='journal_files', type=int,
+                        default=DecisionJournal.default_spill_backups,
+                        help='Number of rotated decision journal files to keep')
     args = parser.parse_args(sys.argv[1:])
     service_name = 'trigger-bot'
     logger = setup_logging(service_name, args.log_dir, args.log_stderr)
@@ -149,7 +163,30 @@ def run():
     user, pw = read_pulse_auth()
     get_users()
 
-    tw = TreeWatcher(ldap_auth)
+    spill_path = None
+    if args.log_dir:
+        spill_path = os.path.join(args.log_dir, 'decisions.tsv')
+    journal = DecisionJournal(spill_path=spill_path,
+                              spill_max_bytes=args.journal_file_mb * 1000000,
+                              spill_backups=args.journal_files)
+    # Don't lose evicted decisions that haven't been written out yet.
+    atexit.register(journal.flush)
+    if args.log_dir:
+        # python -m triggerbot.journal <log dir> <rev> asks us about a revision.
+        journal_server = journal.serve(os.path.join(args.log_dir, 'decisions.sock'))
+        atexit.register(journal_server.close)
+
+    trigger_queue = None
+    if args.trigger_workers:
+        trigger_queue = TriggerQueue()
+        trigger_queue.start(args.trigger_workers)
+        add_report(trigger_queue.report)
+    tw = TreeWatcher(ldap_auth, journal=journal, trigger_queue=trigger_queue)
+
+    # SIGUSR1 toggles a profiler over the pulse callback, SIGUSR2 toggles
+    # per-stage timing (reported with the trigger queue's latencies).
+    # Results go to --log-dir.
+    install_signal_handlers(args.log_dir)
 
     consumer = consumers.BuildConsumer(applabel=service_name,
                                        user=user,